@@ -3,90 +3,148 @@ from __future__ import print_function
 import json
 import logging
 import os
-import signal
+import queue
 import sys
-import time
 import re
+import threading
 
 import configparser
 
 from contextlib import contextmanager
+from functools import lru_cache
+from time import monotonic
 
 if False:
     from mypy_extensions import NoReturn
-from typing import Any, Optional, List, Dict, IO, Text, Set
+from typing import Any, Optional, List, Dict, IO, Text, Set, Pattern, Tuple, Union
 from types import ModuleType
 
 from zulip import Client, ZulipError
 from zulip_bots.custom_exceptions import ConfigValidationError
 
+logger = logging.getLogger(__name__)
+
 class NoBotConfigException(Exception):
     pass
 
-def exit_gracefully(signum, frame):
-    # type: (int, Optional[Any]) -> None
-    sys.exit(0)
-
 def get_bots_directory_path():
     # type: () -> str
     current_dir = os.path.dirname(os.path.abspath(__file__))
     return os.path.join(current_dir, 'bots')
 
+RATE_LIMIT_ERROR_MESSAGE = (
+    '-----> !*!*!*MESSAGE RATE LIMIT REACHED, EXITING*!*!*! <-----\n'
+    'Is your bot trapped in an infinite loop by reacting to its own messages?'
+)
+
 class RateLimit(object):
+    __slots__ = ('message_limit', 'interval_limit', '_prev_count', '_curr_count',
+                 '_window_start')
+
     def __init__(self, message_limit, interval_limit):
         # type: (int, int) -> None
         self.message_limit = message_limit
         self.interval_limit = interval_limit
-        self.message_list = []  # type: List[float]
-        self.error_message = '-----> !*!*!*MESSAGE RATE LIMIT REACHED, EXITING*!*!*! <-----\n'
-        'Is your bot trapped in an infinite loop by reacting to its own messages?'
+        # Sliding window counter: rather than remembering a timestamp per
+        # message, we count messages in the current and previous fixed
+        # windows and weight the previous count by how much of it still
+        # overlaps the sliding window.
+        self._prev_count = 0
+        self._curr_count = 0
+        self._window_start = monotonic()
 
     def is_legal(self):
         # type: () -> bool
-        self.message_list.append(time.time())
-        if len(self.message_list) > self.message_limit:
-            self.message_list.pop(0)
-            time_diff = self.message_list[-1] - self.message_list[0]
-            return time_diff >= self.interval_limit
-        else:
-            return True
+        now = monotonic()
+        interval = self.interval_limit
+        window_start = self._window_start
+        elapsed = now - window_start
+        if elapsed >= interval:
+            if elapsed < 2 * interval:
+                self._prev_count = self._curr_count
+            else:
+                self._prev_count = 0
+            self._curr_count = 0
+            window_start += interval * (elapsed // interval)
+            self._window_start = window_start
+
+        curr_count = self._curr_count
+        weight = 1 - (now - window_start) / interval
+        estimated_count = self._prev_count * weight + curr_count
+        if estimated_count >= self.message_limit:
+            return False
+        self._curr_count = curr_count + 1
+        return True
 
     def show_error_and_exit(self):
         # type: () -> NoReturn
-        logging.error(self.error_message)
+        logging.error(RATE_LIMIT_ERROR_MESSAGE)
         sys.exit(1)
 
 class StateHandlerError(Exception):
     pass
 
 class StateHandler(object):
+    __slots__ = ('_client', 'marshal', 'demarshal', '_modified_entries', '_last_flush',
+                 'state_')
+
+    # `put` only records modified keys; they are sent to the server in
+    # a single `update_storage` call by `flush`.  `maybe_flush` only does
+    # so once FLUSH_N keys are pending or FLUSH_SECONDS have passed since
+    # the last flush.
+    FLUSH_N = 16
+    FLUSH_SECONDS = 1.0
+
     def __init__(self, client):
         # type: (Client) -> None
         self._client = client
-        self.marshal = lambda obj: json.dumps(obj)
-        self.demarshal = lambda obj: json.loads(obj)
+        self.marshal = json.dumps
+        self.demarshal = json.loads
+        self._modified_entries = set()  # type: Set[Text]
+        self._last_flush = 0.0
         response = self._client.get_storage()
         if response['result'] == 'success':
-            self.state_ = response['storage']
+            # Values are kept decoded in memory and only marshalled on save.
+            self.state_ = {key: self.demarshal(value)
+                           for key, value in response['storage'].items()}
         else:
             raise StateHandlerError("Error initializing state: {}".format(str(response)))
 
     def put(self, key, value):
         # type: (Text, Any) -> None
-        self.state_[key] = self.marshal(value)
-        response = self._client.update_storage({'storage': {key: self.state_[key]}})
+        self.state_[key] = value
+        self._modified_entries.add(key)
+
+    def maybe_flush(self):
+        # type: () -> None
+        if self._modified_entries and (
+                len(self._modified_entries) >= self.FLUSH_N or
+                monotonic() - self._last_flush > self.FLUSH_SECONDS):
+            self.flush()
+
+    def flush(self):
+        # type: () -> None
+        self._last_flush = monotonic()
+        if not self._modified_entries:
+            return
+        storage = {key: self.marshal(self.state_[key]) for key in self._modified_entries}
+        response = self._client.update_storage({'storage': storage})
         if response['result'] != 'success':
             raise StateHandlerError("Error updating state: {}".format(str(response)))
+        self._modified_entries.clear()
 
     def get(self, key):
         # type: (Text) -> Any
-        return self.demarshal(self.state_[key])
+        return self.state_[key]
 
     def contains(self, key):
         # type: (Text) -> bool
         return key in self.state_
 
 class ExternalBotHandler(object):
+    __slots__ = ('_rate_limit', '_client', '_root_dir', 'bot_details', 'bot_config_file',
+                 '_storage', '_config_cache', 'user_id', 'full_name', 'email')
+
     def __init__(self, client, root_dir, bot_details, bot_config_file):
         # type: (Client, str, Dict[str, Any], str) -> None
         # Only expose a subset of our Client's functionality
@@ -110,10 +168,13 @@ class ExternalBotHandler(object):
 
         self._rate_limit = RateLimit(20, 5)
         self._client = client
-        self._root_dir = root_dir
+        # Resolve the bot's directory once, so that `open` doesn't
+        # have to touch the filesystem to check paths against it.
+        self._root_dir = os.path.realpath(root_dir) if root_dir is not None else None
         self.bot_details = bot_details
         self.bot_config_file = bot_config_file
         self._storage = StateHandler(client)
+        self._config_cache = {}  # type: Dict[str, Dict[str, Any]]
         try:
             self.user_id = user_profile['user_id']
             self.full_name = user_profile['full_name']
@@ -138,18 +199,18 @@ class ExternalBotHandler(object):
     def send_reply(self, message, response):
         # type: (Dict[str, Any], str) -> Dict[str, Any]
         if message['type'] == 'private':
-            return self.send_message(dict(
-                type='private',
-                to=[x['email'] for x in message['display_recipient'] if self.email != x['email']],
-                content=response,
-            ))
+            return self.send_message({
+                'type': 'private',
+                'to': [x['email'] for x in message['display_recipient'] if self.email != x['email']],
+                'content': response,
+            })
         else:
-            return self.send_message(dict(
-                type='stream',
-                to=message['display_recipient'],
-                subject=message['subject'],
-                content=response,
-            ))
+            return self.send_message({
+                'type': 'stream',
+                'to': message['display_recipient'],
+                'subject': message['subject'],
+                'content': response,
+            })
 
     def update_message(self, message):
         # type: (Dict[str, Any]) -> Dict[str, Any]
@@ -163,7 +224,7 @@ class ExternalBotHandler(object):
 
         if self.bot_config_file is None:
             if optional:
-                return dict()
+                return {}
 
             # Well written bots should catch this exception
             # and provide nice error messages with instructions
@@ -172,6 +233,10 @@ class ExternalBotHandler(object):
             # to specify the file in the command line.
             raise NoBotConfigException(bot_name)
 
+        # Config files don't change while a bot is running.
+        if bot_name in self._config_cache:
+            return dict(self._config_cache[bot_name])
+
         if bot_name not in self.bot_config_file:
             print('''
                 WARNING!
@@ -188,24 +253,25 @@ class ExternalBotHandler(object):
 
         # We expect the caller to pass in None if the user does
         # not specify a bot_config_file.  If they pass in a bogus
-        # filename, we'll let an IOError happen here.  Callers
+        # filename, we raise an IOError here.  Callers
         # like `run.py` will do the command line parsing and checking
         # for the existence of the file.
         config = configparser.ConfigParser()
-        with open(self.bot_config_file) as conf:
-            try:
-                config.readfp(conf)  # type: ignore # readfp->read_file in python 3, so not in stubs
-            except configparser.Error as e:
-                display_config_file_errors(str(e), self.bot_config_file)
-                sys.exit(1)
+        try:
+            read_files = config.read(self.bot_config_file)
+        except configparser.Error as e:
+            display_config_file_errors(str(e), self.bot_config_file)
+            sys.exit(1)
+        if not read_files:
+            raise IOError("Could not read config file {}".format(self.bot_config_file))
 
-        return dict(config.items(bot_name))
+        self._config_cache[bot_name] = dict(config.items(bot_name))
+        return dict(self._config_cache[bot_name])
 
     def open(self, filepath):
         # type: (str) -> IO[str]
-        filepath = os.path.normpath(filepath)
-        abs_filepath = os.path.join(self._root_dir, filepath)
-        if abs_filepath.startswith(self._root_dir):
+        abs_filepath = os.path.normpath(os.path.join(self._root_dir, filepath))
+        if os.path.commonpath([abs_filepath, self._root_dir]) == self._root_dir:
             return open(abs_filepath)
         else:
             raise PermissionError("Cannot open file \"{}\". Bots may only access "
@@ -221,10 +287,16 @@ def extract_query_without_mention(message, client):
     If the bot is the first @mention in the message, then this function returns
     the stripped message with the bot's @mention removed.  Otherwise, it returns None.
     """
-    mention = '@**' + client.full_name + '**'
-    if not message['content'].startswith(mention):
+    content = message['content']
+    match = get_mention_regex(client.full_name).match(content)
+    if match is None:
         return None
-    return message['content'][len(mention):].lstrip()
+    return content[match.end():]
+
+@lru_cache(maxsize=None)
+def get_mention_regex(full_name):
+    # type: (str) -> Pattern[str]
+    return re.compile(r'@\*\*' + re.escape(full_name) + r'\*\*\s*')
 
 def is_private_message_from_another_user(message_dict, current_user_id):
     # type: (Dict[str, Any], int) -> bool
@@ -290,13 +362,18 @@ def run_message_handler_for_bot(lib_module, quiet, config_file, bot_config_file,
             print("\n\t{}".format(bot_details['description']))
         print(message_handler.usage())
 
+    store = restricted_client._storage
+    user_id = restricted_client.user_id
+
     def handle_message(message, flags):
         # type: (Dict[str, Any], List[str]) -> None
-        logging.info('waiting for next message')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('waiting for next message')
         # `mentioned` will be in `flags` if the bot is mentioned at ANY position
         # (not necessarily the first @mention in the message).
         is_mentioned = 'mentioned' in flags
-        is_private_message = is_private_message_from_another_user(message, restricted_client.user_id)
+        # Inlined version of is_private_message_from_another_user.
+        is_private_message = message['type'] == 'private' and message['sender_id'] != user_id
 
         # Provide bots with a way to access the full, unstripped message
         message['full_content'] = message['content']
@@ -314,13 +391,66 @@ def run_message_handler_for_bot(lib_module, quiet, config_file, bot_config_file,
                 bot_handler=restricted_client
             )
 
-    signal.signal(signal.SIGINT, exit_gracefully)
-
-    logging.info('starting message handling...')
+    # Events are received in a separate thread, so that the bot's own API
+    # calls don't hold up receiving the next events.  Messages are handled
+    # here, in the calling thread, so that errors and `sys.exit` calls
+    # from the bot (e.g. `quit` or the rate limiter) stop it right away.
+    # The queue is bounded; once it is full, receiving events blocks until
+    # the bot catches up.  Besides messages, the queue carries the
+    # exception that ended polling, or None if it ended normally.
+    message_queue = queue.Queue(maxsize=64)  # type: queue.Queue[Union[Tuple[Dict[str, Any], List[str]], BaseException, None]]
+    stop_polling = threading.Event()
 
     def event_callback(event):
         # type: (Dict[str, Any]) -> None
+        if stop_polling.is_set():
+            # Ends this thread once the bot has stopped.
+            sys.exit(0)
         if event['type'] == 'message':
-            handle_message(event['message'], event['flags'])
+            message_queue.put((event['message'], event['flags']))
+
+    def poll_events():
+        # type: () -> None
+        try:
+            client.call_on_each_event(event_callback, ['message'])
+        except BaseException as e:
+            if not stop_polling.is_set():
+                message_queue.put(e)
+        else:
+            message_queue.put(None)
+
+    poller = threading.Thread(target=poll_events, name='bot-event-poller')
+    poller.daemon = True
+
+    logger.info('starting message handling...')
 
-    client.call_on_each_event(event_callback, ['message'])
+    poller.start()
+    try:
+        while True:
+            item = message_queue.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            handle_message(*item)
+            # Flush storage writes as soon as we have caught up with
+            # incoming messages, and regularly while messages keep
+            # arriving, so that they aren't held back until some later
+            # message.
+            if message_queue.empty():
+                store.flush()
+            else:
+                store.maybe_flush()
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        stop_polling.set()
+        # Unblock the poller if it is waiting on a full queue; messages
+        # that haven't been handled yet are dropped.
+        try:
+            while True:
+                message_queue.get_nowait()
+        except queue.Empty:
+            pass
+        # Don't lose storage writes that haven't been flushed yet.
+        store.flush()
@@ -1,7 +1,14 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
 from unittest import TestCase
 from unittest.mock import MagicMock, patch, ANY, create_autospec
 from zulip_bots.lib import (
     ExternalBotHandler,
+    RateLimit,
     StateHandler,
     run_message_handler_for_bot,
 )
@@ -28,7 +35,7 @@ class FakeClient:
     def get_storage(self):
         return dict(
             result='success',
-            storage=self.storage,
+            storage=dict(self.storage),
         )
 
     def send_message(self, message):
@@ -58,6 +65,22 @@ class LibTest(TestCase):
         message = None
         handler.send_message(message)
 
+    def test_rate_limit(self):
+        with patch('zulip_bots.lib.monotonic') as mock_time:
+            mock_time.return_value = 0
+            rate_limit = RateLimit(message_limit=3, interval_limit=10)
+            for now in [0, 1, 2]:
+                mock_time.return_value = now
+                self.assertTrue(rate_limit.is_legal())
+            mock_time.return_value = 3
+            self.assertFalse(rate_limit.is_legal())
+            # The previous window's count is weighted by its overlap
+            # with the sliding window.
+            mock_time.return_value = 10
+            self.assertFalse(rate_limit.is_legal())
+            mock_time.return_value = 15
+            self.assertTrue(rate_limit.is_legal())
+
     def test_state_handler(self):
         client = FakeClient()
 
@@ -66,6 +89,11 @@ class LibTest(TestCase):
         val = state_handler.get('key')
         self.assertEqual(val, [1, 2, 3])
 
+        # writes are batched until the handler is saved
+        self.assertNotIn('key', client.storage)
+        state_handler.flush()
+        self.assertEqual(json.loads(client.storage['key']), [1, 2, 3])
+
         # force us to get non-cached values
         state_handler = StateHandler(client)
         val = state_handler.get('key')
@@ -93,6 +121,50 @@ class LibTest(TestCase):
             handler.send_reply(test[0], response_text)
             client.send_message.assert_called_once_with(dict(test[1], content=response_text))
 
+    def test_get_config_info(self):
+        client = FakeClient()
+        with tempfile.NamedTemporaryFile('w', suffix='testbot.conf', delete=False) as conf:
+            conf.write('[testbot]\nkey = value\n')
+        handler = ExternalBotHandler(
+            client=client,
+            root_dir=None,
+            bot_details=None,
+            bot_config_file=conf.name
+        )
+        self.assertEqual(handler.get_config_info('testbot'), {'key': 'value'})
+
+        # the parsed config is cached, so the file isn't read again
+        os.remove(conf.name)
+        self.assertEqual(handler.get_config_info('testbot'), {'key': 'value'})
+
+    def test_open(self):
+        client = FakeClient()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = os.path.realpath(tmp_dir)
+            root_dir = os.path.join(tmp_dir, 'foo')
+            os.mkdir(root_dir)
+            os.mkdir(os.path.join(tmp_dir, 'foobar'))
+            for path in ['foo/data.txt', 'secret', 'foobar/secret']:
+                with open(os.path.join(tmp_dir, path), 'w') as f:
+                    f.write(path)
+
+            handler = ExternalBotHandler(
+                client=client,
+                root_dir=root_dir,
+                bot_details=None,
+                bot_config_file=None
+            )
+            with handler.open('data.txt') as f:
+                self.assertEqual(f.read(), 'foo/data.txt')
+            with handler.open('../foo/data.txt') as f:
+                self.assertEqual(f.read(), 'foo/data.txt')
+            # Neither the parent directory nor a sibling directory whose
+            # name starts with the bot's directory name may be accessed.
+            with self.assertRaises(PermissionError):
+                handler.open('../secret')
+            with self.assertRaises(PermissionError):
+                handler.open('../foobar/secret')
+
     def test_content_and_full_content(self):
         client = FakeClient()
         profile = client.get_profile()
@@ -112,6 +184,14 @@ class LibTest(TestCase):
             mock_bot_handler = create_autospec(FakeBotHandler)
             mock_lib_module.handler_class.return_value = mock_bot_handler
 
+            # In the following test, expected_message is the dict that we expect
+            # to be passed to the bot's handle_message function.
+            original_message = {'content': '@**Alice** bar',
+                                'type': 'stream'}
+            expected_message = {'type': 'stream',
+                                'content': 'bar',
+                                'full_content': '@**Alice** bar'}
+
             def call_on_each_event_mock(self, callback, event_types=None, narrow=None):
                 def test_message(message, flags):
                     event = {'message': message,
@@ -119,17 +199,7 @@ class LibTest(TestCase):
                              'type': 'message'}
                     callback(event)
 
-                # In the following test, expected_message is the dict that we expect
-                # to be passed to the bot's handle_message function.
-                original_message = {'content': '@**Alice** bar',
-                                    'type': 'stream'}
-                expected_message = {'type': 'stream',
-                                    'content': 'bar',
-                                    'full_content': '@**Alice** bar'}
                 test_message(original_message, {'mentioned'})
-                mock_bot_handler.handle_message.assert_called_with(
-                    message=expected_message,
-                    bot_handler=ANY)
 
             fake_client.call_on_each_event = call_on_each_event_mock.__get__(
                 fake_client, fake_client.__class__)
@@ -138,3 +208,78 @@ class LibTest(TestCase):
                                         config_file=None,
                                         bot_config_file=None,
                                         bot_name='testbot')
+            # Messages are handled in a worker thread, which has finished
+            # all queued messages once run_message_handler_for_bot returns.
+            mock_bot_handler.handle_message.assert_called_with(
+                message=expected_message,
+                bot_handler=ANY)
+
+    def test_run_message_handler_for_bot_propagates_worker_errors(self):
+        with patch('zulip_bots.lib.Client', new=FakeClient) as fake_client:
+            mock_lib_module = MagicMock()
+            mock_lib_module.__file__ = "foo"
+            mock_bot_handler = create_autospec(FakeBotHandler)
+            mock_bot_handler.handle_message.side_effect = SystemExit(1)
+            mock_lib_module.handler_class.return_value = mock_bot_handler
+
+            def call_on_each_event_mock(self, callback, event_types=None, narrow=None):
+                callback({'message': {'content': 'foo', 'type': 'private', 'sender_id': 'bob'},
+                          'flags': [],
+                          'type': 'message'})
+                # Simulate a long poll that doesn't return any more events.
+                release_poll.wait(10)
+                poll_returned.append(True)
+
+            release_poll = threading.Event()
+            poll_returned = []
+            fake_client.call_on_each_event = call_on_each_event_mock.__get__(
+                fake_client, fake_client.__class__)
+            try:
+                with self.assertRaises(SystemExit):
+                    run_message_handler_for_bot(lib_module=mock_lib_module,
+                                                quiet=True,
+                                                config_file=None,
+                                                bot_config_file=None,
+                                                bot_name='testbot')
+                # The bot's `sys.exit` ended run_message_handler_for_bot
+                # without waiting for the pending long poll.
+                self.assertEqual(poll_returned, [])
+            finally:
+                release_poll.set()
+
+    def test_run_message_handler_for_bot_flushes_storage_when_idle(self):
+        with patch('zulip_bots.lib.Client', new=FakeClient) as fake_client:
+            mock_lib_module = MagicMock()
+            mock_lib_module.__file__ = "foo"
+            mock_bot_handler = create_autospec(FakeBotHandler)
+            clients = []
+
+            def handle_message(message, bot_handler):
+                clients.append(bot_handler._client)
+                bot_handler.storage.put('key', len(clients))
+
+            mock_bot_handler.handle_message.side_effect = handle_message
+            mock_lib_module.handler_class.return_value = mock_bot_handler
+            saved_storage = []
+
+            def call_on_each_event_mock(self, callback, event_types=None, narrow=None):
+                for _ in range(2):
+                    callback({'message': {'content': 'foo', 'type': 'private', 'sender_id': 'bob'},
+                              'flags': [],
+                              'type': 'message'})
+                # The last write should reach the server once the worker is
+                # idle, without waiting for another event or for the bot to stop.
+                for _ in range(100):
+                    if clients and clients[0].storage.get('key') == '2':
+                        break
+                    time.sleep(0.01)
+                saved_storage.append(dict(clients[0].storage))
+
+            fake_client.call_on_each_event = call_on_each_event_mock.__get__(
+                fake_client, fake_client.__class__)
+            run_message_handler_for_bot(lib_module=mock_lib_module,
+                                        quiet=True,
+                                        config_file=None,
+                                        bot_config_file=None,
+                                        bot_name='testbot')
+            self.assertEqual(saved_storage, [{'key': '2'}])
@@ -3,7 +3,7 @@ import os
 
 from importlib import import_module
 
-from typing import Any, Dict
+from typing import Any, Dict, Tuple
 
 '''
 This module helps us find files in the bots directory.  Our
@@ -24,12 +24,19 @@ def get_bot_message_handler(bot_name):
     lib_module = import_module('zulip_bots.bots.{bot}.{bot}'.format(bot=bot_name))  # type: Any
     return lib_module.handler_class()
 
+# Cache the raw file contents, so that fixtures read by several tests
+# only hit the disk once.  Each call still parses its own copy, so tests
+# modifying their fixture data don't affect other tests.
+_fixture_cache = {}  # type: Dict[Tuple[str, str], str]
+
 def read_bot_fixture_data(bot_name, test_name):
     # type: (str, str) -> Dict[str, Any]
-    base_path = os.path.realpath(os.path.join(os.path.dirname(
-        os.path.abspath(__file__)), 'bots', bot_name, 'fixtures'))
-    http_data_path = os.path.join(base_path, '{}.json'.format(test_name))
-    with open(http_data_path, encoding='utf-8') as f:
-        content = f.read()
-    http_data = json.loads(content)
+    key = (bot_name, test_name)
+    if key not in _fixture_cache:
+        base_path = os.path.realpath(os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), 'bots', bot_name, 'fixtures'))
+        http_data_path = os.path.join(base_path, '{}.json'.format(test_name))
+        with open(http_data_path, encoding='utf-8') as f:
+            _fixture_cache[key] = f.read()
+    http_data = json.loads(_fixture_cache[key])
     return http_data
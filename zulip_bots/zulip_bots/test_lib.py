@@ -1,7 +1,7 @@
 from unittest.mock import patch
 from unittest import TestCase
 
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Optional, Tuple
 
 from zulip_bots.custom_exceptions import (
     ConfigValidationError,
@@ -23,6 +23,9 @@ from zulip_bots.test_file_utils import (
 )
 
 class StubBotHandler:
+    __slots__ = ('storage', 'full_name', 'email', 'message_server', 'transcript',
+                 '_reply_count', '_last_reply', '_message_count', '_last_message')
+
     def __init__(self):
         # type: () -> None
         self.storage = SimpleStorage()
@@ -34,18 +37,29 @@ class StubBotHandler:
     def reset_transcript(self):
         # type: () -> None
         self.transcript = []  # type: List[Tuple[str, Dict[str, Any]]]
+        # Track replies and messages as they are sent, so that
+        # `unique_reply` and `unique_response` don't need to scan
+        # the transcript.
+        self._reply_count = 0
+        self._last_reply = None  # type: Optional[Dict[str, Any]]
+        self._message_count = 0
+        self._last_message = None  # type: Optional[Dict[str, Any]]
 
     def send_message(self, message):
         # type: (Dict[str, Any]) -> Dict[str, Any]
         self.transcript.append(('send_message', message))
+        self._message_count += 1
+        self._last_message = message
         return self.message_server.send(message)
 
     def send_reply(self, message, response):
         # type: (Dict[str, Any], str) -> Dict[str, Any]
-        response_message = dict(
-            content=response
-        )
+        response_message = {
+            'content': response,
+        }
         self.transcript.append(('send_reply', response_message))
+        self._reply_count += 1
+        self._last_reply = response_message
         return self.message_server.send(response_message)
 
     def update_message(self, message):
@@ -65,30 +79,22 @@ class StubBotHandler:
 
     def unique_reply(self):
         # type: () -> Dict[str, Any]
-        responses = [
-            message
-            for (method, message)
-            in self.transcript
-            if method == 'send_reply'
-        ]
-        self.ensure_unique_response(responses)
-        return responses[0]
+        self.ensure_unique_response(self._reply_count)
+        assert self._last_reply is not None
+        return self._last_reply
 
     def unique_response(self):
         # type: () -> Dict[str, Any]
-        responses = [
-            message
-            for (method, message)
-            in self.transcript
-        ]
-        self.ensure_unique_response(responses)
-        return responses[0]
-
-    def ensure_unique_response(self, responses):
-        # type: (List[Dict[str, Any]]) -> None
-        if not responses:
+        self.ensure_unique_response(self._reply_count + self._message_count)
+        response = self._last_reply if self._reply_count else self._last_message
+        assert response is not None
+        return response
+
+    def ensure_unique_response(self, response_count):
+        # type: (int) -> None
+        if response_count == 0:
             raise Exception('The bot is not responding for some reason.')
-        if len(responses) > 1:
+        if response_count > 1:
             raise Exception('The bot is giving too many responses for some reason.')
 
 class BotTestCase(TestCase):
@@ -96,6 +102,9 @@ class BotTestCase(TestCase):
 
     def _get_handlers(self):
         # type: () -> Tuple[Any, StubBotHandler]
+        # Handlers are built per request rather than once in `setUp`,
+        # since bots' `initialize` usually reads config that tests
+        # patch in with `mock_config_info` around the request.
         bot = get_bot_message_handler(self.bot_name)
         bot_handler = StubBotHandler()
 
@@ -107,7 +116,6 @@ class BotTestCase(TestCase):
     def get_response(self, message):
         # type: (Dict[str, Any]) -> Dict[str, Any]
         bot, bot_handler = self._get_handlers()
-        bot_handler.reset_transcript()
         bot.handle_message(message, bot_handler)
         return bot_handler.unique_response()
 
@@ -118,20 +126,19 @@ class BotTestCase(TestCase):
         tests can override this behavior by
         mocking/subclassing.
         '''
-        message = dict(
-            display_recipient='foo_stream',
-            sender_email='foo@example.com',
-            sender_full_name='Foo Test User',
-            sender_id='123',
-            content=content,
-        )
+        message = {
+            'display_recipient': 'foo_stream',
+            'sender_email': 'foo@example.com',
+            'sender_full_name': 'Foo Test User',
+            'sender_id': '123',
+            'content': content,
+        }
         return message
 
     def get_reply_dict(self, request):
         # type: (str) -> Dict[str, Any]
         bot, bot_handler = self._get_handlers()
         message = self.make_request_message(request)
-        bot_handler.reset_transcript()
         bot.handle_message(message, bot_handler)
         reply = bot_handler.unique_reply()
         return reply
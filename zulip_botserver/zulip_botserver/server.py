@@ -86,6 +86,9 @@ def handle_bot(bot):
     event = request.get_json(force=True)
     message_handler.handle_message(message=event["message"],
                                    bot_handler=bot_handlers[bot])
+    # Each request is handled independently, so don't leave
+    # storage writes pending once the bot is done with it.
+    bot_handlers[bot].storage.flush()
     return json.dumps("")
 
 def parse_args():